@@ -1,6 +1,5 @@
 import argparse
-import json
-from mini_ai.markov import MarkovChain
+from mini_ai.markov import MarkovChain, load_model, save_model
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(description="Markov Chain Text Generator")
     subparsers = parser.add_subparsers(dest='command')
@@ -9,9 +8,10 @@ def main(argv: list[str] | None = None) -> int:
     train_parser.add_argument('--input', required=True, type=str, help='Input text file path')
     train_parser.add_argument('--model-out', required=True, type=str, help='Output model file path')
     train_parser.add_argument('--order', required=True, type=int, help='Order of the Markov chain')
+    train_parser.add_argument('--format', choices=['auto', 'json', 'pickle'], default='auto', help='Model file format; auto picks json for a .json path, pickle otherwise')
 
     generate_parser = subparsers.add_parser('generate', help='Generate text using a trained Markov chain model')
-    generate_parser.add_argument('--model', required=True, type=str, help='Trained model file path')
+    generate_parser.add_argument('--model', required=True, type=str, help='Trained model file path (JSON or pickle; only load pickle files you trust)')
     generate_parser.add_argument('--length', required=True, type=int, help='Length of the generated text')
     generate_parser.add_argument('--seed', type=str, help='Seed for the generated text')
     generate_parser.add_argument('--random-seed', type=int, help='Random seed for reproducibility')
@@ -19,19 +19,16 @@ def main(argv: list[str] | None = None) -> int:
     args = parser.parse_args(argv)
 
     if args.command == 'train':
-        with open(args.input, 'r', encoding='utf-8') as f:
-            text = f.read()
         mc = MarkovChain(order=args.order)
-        mc.train(text)
-        with open(args.model_out, 'w', encoding='utf-8') as f:
-            json.dump(mc.to_dict(), f)
+        with open(args.input, 'r', encoding='utf-8') as f:
+            mc.train_iter(iter(lambda: f.read(1 << 20), ''))
+        save_model(mc, args.model_out, args.format)
         return 0
     elif args.command == 'generate':
-        with open(args.model, 'r', encoding='utf-8') as f:
-            d = json.load(f)
-        mc = MarkovChain.from_dict(d)
-        generated_text = mc.generate(length=args.length, seed=args.seed, random_seed=args.random_seed)
-        print(generated_text)
+        mc = load_model(args.model)
+        for block in mc.generate_iter(length=args.length, seed=args.seed, random_seed=args.random_seed):
+            print(block, end='')
+        print()
         return 0
     else:
         parser.print_help()
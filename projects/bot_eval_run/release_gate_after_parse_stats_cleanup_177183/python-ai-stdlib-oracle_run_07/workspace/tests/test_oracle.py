@@ -4,7 +4,9 @@ import os
 import tempfile
 import unittest
 from contextlib import redirect_stdout
+from unittest import mock
 
+from mini_ai import markov
 from mini_ai.markov import MarkovChain
 from mini_ai.cli import main
 
@@ -66,3 +68,27 @@ class TestCliOracle(unittest.TestCase):
             generated = buf.getvalue().strip()
             self.assertEqual(len(generated), 12)
 
+
+class TestAliasSampling(unittest.TestCase):
+    def test_alias_table_matches_weights(self):
+        weights = (1, 3, 0, 4)
+        prob, alias = markov._build_alias_table(weights)
+        n = len(weights)
+        mass = [p / n for p in prob]
+        for i in range(n):
+            mass[alias[i]] += (1.0 - prob[i]) / n
+        total = sum(weights)
+        for got, w in zip(mass, weights):
+            self.assertAlmostEqual(got, w / total)
+
+    def test_alias_sampling_follows_counts(self):
+        # Every context is wide enough for the alias path once the threshold is 1.
+        with mock.patch.object(markov, "_ALIAS_MIN_SUCCESSORS", 1):
+            mc = MarkovChain(order=1)
+            mc.train("abacacac")
+            out = mc.generate(length=20001, seed="a", random_seed=1)
+        self.assertIsNotNone(mc._table[mc._context_ids["a"]][3])
+        self.assertEqual(out[::2], "a" * 10001)
+        after_a = out[1::2]
+        self.assertTrue(set(after_a) <= {"b", "c"})
+        self.assertAlmostEqual(after_a.count("c") / len(after_a), 0.75, delta=0.03)
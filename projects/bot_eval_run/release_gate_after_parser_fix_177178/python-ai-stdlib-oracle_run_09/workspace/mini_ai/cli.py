@@ -1,7 +1,5 @@
 import argparse
-import json
-import os
-from mini_ai.markov import MarkovChain
+from mini_ai.markov import MarkovChain, load_model, save_model
 
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(description="Markov Chain Text Generator")
@@ -12,10 +10,11 @@ def main(argv: list[str] | None = None) -> int:
     train_parser.add_argument('--input', type=str, required=True, help='Path to input text file')
     train_parser.add_argument('--model-out', type=str, required=True, help='Path to save the trained model')
     train_parser.add_argument('--order', type=int, required=True, help='Order of the Markov chain')
+    train_parser.add_argument('--format', choices=['auto', 'json', 'pickle'], default='auto', help='Model file format; auto picks json for a .json path, pickle otherwise')
 
     # Generate command
     generate_parser = subparsers.add_parser('generate')
-    generate_parser.add_argument('--model', type=str, required=True, help='Path to trained model JSON file')
+    generate_parser.add_argument('--model', type=str, required=True, help='Path to trained model file (JSON or pickle; only load pickle files you trust)')
     generate_parser.add_argument('--length', type=int, required=True, help='Length of the generated text')
     generate_parser.add_argument('--seed', type=str, default=None, help='Seed string for deterministic generation')
     generate_parser.add_argument('--random-seed', type=int, default=None, help='Random seed for reproducibility')
@@ -23,19 +22,16 @@ def main(argv: list[str] | None = None) -> int:
     args = parser.parse_args(argv)
 
     if args.command == 'train':
-        with open(args.input, 'r', encoding='utf-8') as f:
-            text = f.read()
         mc = MarkovChain(order=args.order)
-        mc.train(text)
-        with open(args.model_out, 'w', encoding='utf-8') as f:
-            json.dump(mc.to_dict(), f)
+        with open(args.input, 'r', encoding='utf-8') as f:
+            mc.train_iter(iter(lambda: f.read(1 << 20), ''))
+        save_model(mc, args.model_out, args.format)
         return 0
     elif args.command == 'generate':
-        with open(args.model, 'r', encoding='utf-8') as f:
-            model_data = json.load(f)
-        mc = MarkovChain.from_dict(model_data)
-        generated_text = mc.generate(length=args.length, seed=args.seed, random_seed=args.random_seed)
-        print(generated_text)
+        mc = load_model(args.model)
+        for block in mc.generate_iter(length=args.length, seed=args.seed, random_seed=args.random_seed):
+            print(block, end='')
+        print()
         return 0
     else:
         parser.print_help()
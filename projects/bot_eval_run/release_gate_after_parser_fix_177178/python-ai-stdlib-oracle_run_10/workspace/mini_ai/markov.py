@@ -1,50 +1,203 @@
 from __future__ import annotations
 import json
+import pickle
 import random
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict, deque
+from itertools import accumulate
+from operator import add
+from typing import Iterable, Iterator
+
+# In pure Python the alias draw only beats a C-level bisect for very wide fan-out.
+_ALIAS_MIN_SUCCESSORS = 1024
+# generate_iter() draws uniforms and yields text this many characters at a time.
+_GENERATE_BLOCK = 1 << 16
+# Unseeded calls share this generator; seeded calls get their own, so neither touches the global one.
+_rng = random.Random()
+
+
+def _build_alias_table(weights: tuple[int, ...]) -> tuple[array, array]:
+    """Build Vose alias tables so a weighted draw costs O(1)."""
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    prob = array('d', [1.0]) * n
+    alias = array('i', range(n))
+    small = deque(i for i, p in enumerate(scaled) if p < 1.0)
+    large = deque(i for i, p in enumerate(scaled) if p >= 1.0)
+    while small and large:
+        s = small.popleft()
+        g = large.popleft()
+        prob[s] = scaled[s]
+        alias[s] = g
+        scaled[g] -= 1.0 - scaled[s]
+        (small if scaled[g] < 1.0 else large).append(g)
+    return prob, alias
+
+
+def _sampling_entry(options: dict, successors: tuple[int, ...]) -> tuple:
+    chars = tuple(options)
+    counts = tuple(options.values())
+    if len(chars) >= _ALIAS_MIN_SUCCESSORS:
+        prob, alias = _build_alias_table(counts)
+        return chars, successors, None, prob, alias
+    total = sum(counts)
+    # Normalised so the last bound is exactly 1.0 and a bare random() can be bisected.
+    cum_weights = array('d', [c / total for c in accumulate(counts)])
+    return chars, successors, cum_weights, None, None
+
+
+def _count_grams(text: str, order: int, grams: Counter) -> None:
+    if order == 1:
+        # Pairing each character with its successor is ~3x cheaper than slicing bigrams.
+        grams.update(map(add, text, text[1:]))
+        return
+    # Slice every (order + 1)-gram through map() so the counting pass runs
+    # without executing Python bytecode per character.
+    windows = map(slice, range(len(text) - order), range(order + 1, len(text) + 1))
+    grams.update(map(text.__getitem__, windows))
+
 
 class MarkovChain:
     def __init__(self, order: int = 1):
         if order <= 0:
             raise ValueError("Order must be a positive integer.")
         self.order = order
-        self.transitions = {}
+        self.transitions = defaultdict(Counter)
+        self._table = None
+        self._context_ids = {}
+        self._keys_tuple = None
 
     def train(self, text: str) -> None:
-        for i in range(len(text) - self.order):
-            context = text[i:i + self.order]
-            next_char = text[i + self.order]
-            if context not in self.transitions:
-                self.transitions[context] = {}
-            if next_char not in self.transitions[context]:
-                self.transitions[context][next_char] = 0
-            self.transitions[context][next_char] += 1
+        grams = Counter()
+        _count_grams(text, self.order, grams)
+        self._fold(grams)
+
+    def train_iter(self, chunks: Iterable[str]) -> None:
+        """Train on text delivered in pieces, e.g. successive reads of a large file."""
+        order = self.order
+        grams = Counter()
+        tail = ''
+        for chunk in chunks:
+            window = tail + chunk
+            _count_grams(window, order, grams)
+            tail = window[-order:]
+        self._fold(grams)
+
+    def _fold(self, grams: Counter) -> None:
+        """Merge flat (order + 1)-gram counts into the nested transitions."""
+        self._table = None
+        transitions = self.transitions
+        if not isinstance(transitions, defaultdict):
+            # from_dict() keeps the loaded plain dicts; switch to counters only when training resumes.
+            transitions = self.transitions = defaultdict(Counter, {c: Counter(o) for c, o in transitions.items()})
+        for gram, count in grams.items():
+            transitions[gram[:-1]][gram[-1]] += count
+
+    def _build_cdf(self) -> None:
+        """Compile transitions into a table of sampling entries indexed by dense context id.
+
+        Each entry lists, per successor, the id of the context it leads to; the
+        trailing None entry is shared by every successor that has no transitions.
+        """
+        transitions = self.transitions
+        context_ids = {context: i for i, context in enumerate(transitions)}
+        dead_end = len(context_ids)
+        get_id = context_ids.get
+        build = _sampling_entry
+        table = []
+        for context, options in transitions.items():
+            rest = context[1:]
+            table.append(build(options, tuple(get_id(rest + c, dead_end) for c in options)))
+        table.append(None)
+        self._context_ids = context_ids
+        self._keys_tuple = None
+        self._table = table
+
+    def _context_keys(self) -> tuple[str, ...]:
+        """Trained contexts as a tuple to draw a random start from, built on first use."""
+        if self._keys_tuple is None:
+            self._keys_tuple = tuple(self._context_ids)
+        return self._keys_tuple
 
     def generate(self, length: int, seed: str | None = None, random_seed: int | None = None) -> str:
-        if random_seed is not None:
-            random.seed(random_seed)
+        return ''.join(self.generate_iter(length, seed, random_seed))
+
+    def generate_iter(self, length: int, seed: str | None = None, random_seed: int | None = None) -> Iterator[str]:
+        """Yield the text generate() would return in blocks, so long outputs need not sit in memory."""
+        rng = random.Random(random_seed) if random_seed is not None else _rng
+        if self._table is None:
+            self._build_cdf()
         if seed is not None and len(seed) == self.order:
             context = seed
         else:
-            context = random.choice(list(self.transitions.keys()))
-        result = list(context)
-        for _ in range(length - self.order):
-            next_char = random.choices(
-                population=list(self.transitions[context].keys()),
-                weights=self.transitions[context].values(),
-                k=1
-            )[0]
-            result.append(next_char)
-            context = ''.join(result[-self.order:])
-        return ''.join(result)
+            context = rng.choice(self._context_keys())
+        _rand = rng.random
+        _bisect = bisect_right
+        table = self._table
+        ctx = self._context_ids.get(context, len(table) - 1)
+        result = [context]
+        _append = result.append
+        remaining = length - self.order
+        while True:
+            n = min(remaining, _GENERATE_BLOCK)
+            remaining -= n
+            for u in [_rand() for _ in range(n)]:
+                entry = table[ctx]
+                if entry is None:
+                    remaining = 0
+                    break
+                chars, successors, cum_weights, prob, alias = entry
+                if prob is None:
+                    j = _bisect(cum_weights, u)
+                else:
+                    # One uniform picks the column; its fractional part tosses the coin.
+                    scaled = u * len(chars)
+                    j = int(scaled)
+                    if scaled - j >= prob[j]:
+                        j = alias[j]
+                _append(chars[j])
+                ctx = successors[j]
+            yield ''.join(result)
+            if remaining <= 0:
+                return
+            result.clear()
 
     def to_dict(self) -> dict:
         return {
             "order": self.order,
-            "transitions": self.transitions
+            "transitions": {context: dict(options) for context, options in self.transitions.items()}
         }
 
     @classmethod
     def from_dict(cls, d: dict) -> "MarkovChain":
         mc = cls(order=d["order"])
         mc.transitions = d["transitions"]
-        return mc
\ No newline at end of file
+        mc._build_cdf()
+        return mc
+
+
+def save_model(mc: MarkovChain, path: str, fmt: str = 'auto') -> None:
+    """Write mc to path; 'auto' picks JSON for a .json path and binary pickle otherwise."""
+    if fmt == 'auto':
+        fmt = 'json' if path.endswith('.json') else 'pickle'
+    if fmt == 'json':
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(mc.to_dict(), f, ensure_ascii=False, separators=(',', ':'), check_circular=False)
+    else:
+        with open(path, 'wb') as f:
+            pickle.dump(mc.to_dict(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(path: str) -> MarkovChain:
+    """Read a model written by save_model() in either format.
+
+    Only load files you trust: a file starting with the pickle PROTO byte is
+    unpickled, and unpickling can run arbitrary code.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    # Pickle protocol 2+ streams start with the PROTO opcode; anything else is JSON.
+    data = pickle.loads(raw) if raw[:1] == b'\x80' else json.loads(raw)
+    return MarkovChain.from_dict(data)
@@ -9,9 +9,10 @@ def main(args=None):
     train_parser.add_argument('--input', required=True, help='Input text file')
     train_parser.add_argument('--model-out', required=True, help='Output model file')
     train_parser.add_argument('--order', type=int, default=1, help='Order of the Markov Chain')
+    train_parser.add_argument('--format', choices=['auto', 'json', 'pickle'], default='auto', help='Model file format; auto picks json for a .json path, pickle otherwise')
 
     generate_parser = subparsers.add_parser('generate', help='Generate text using a Markov Chain model')
-    generate_parser.add_argument('--model', required=True, help='Model file')
+    generate_parser.add_argument('--model', required=True, help='Model file (JSON or pickle; only load pickle files you trust)')
     generate_parser.add_argument('--length', type=int, default=100, help='Length of the generated text')
     generate_parser.add_argument('--seed', help='Seed for the generation')
     generate_parser.add_argument('--random-seed', type=int, help='Random seed for reproducibility')
@@ -19,16 +20,16 @@ def main(args=None):
     args = parser.parse_args(args)
 
     if args.command == 'train':
-        with open(args.input, 'r', encoding='utf-8') as f:
-            text = f.read()
         mc = MarkovChain(order=args.order)
-        mc.train(text)
-        save_model(mc, args.model_out)
+        with open(args.input, 'r', encoding='utf-8') as f:
+            mc.train_iter(iter(lambda: f.read(1 << 20), ''))
+        save_model(mc, args.model_out, args.format)
         return 0
     elif args.command == 'generate':
         mc = load_model(args.model)
-        generated_text = mc.generate(length=args.length, seed=args.seed, random_seed=args.random_seed)
-        print(generated_text)
+        for block in mc.generate_iter(length=args.length, seed=args.seed, random_seed=args.random_seed):
+            print(block, end='')
+        print()
         return 0
     else:
         parser.print_help()
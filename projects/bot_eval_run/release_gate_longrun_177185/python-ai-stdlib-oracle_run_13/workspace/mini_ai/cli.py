@@ -1,6 +1,5 @@
 import argparse
-import json
-from mini_ai.markov import MarkovChain
+from mini_ai.markov import MarkovChain, load_model, save_model
 
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(description="Character-level Markov chain generator.")
@@ -11,10 +10,11 @@ def main(argv: list[str] | None = None) -> int:
     train_parser.add_argument('--input', type=str, required=True, help='Path to the input text file.')
     train_parser.add_argument('--model-out', type=str, required=True, help='Path where the trained model will be saved as a JSON file.')
     train_parser.add_argument('--order', type=int, required=True, help='Order of the Markov chain.')
+    train_parser.add_argument('--format', choices=['auto', 'json', 'pickle'], default='auto', help='Model file format; auto picks json for a .json path, pickle otherwise')
 
     # Generate subcommand
     generate_parser = subparsers.add_parser('generate')
-    generate_parser.add_argument('--model', type=str, required=True, help='Path to the trained model JSON file.')
+    generate_parser.add_argument('--model', type=str, required=True, help='Path to the trained model file (JSON or pickle; only load pickle files you trust).')
     generate_parser.add_argument('--length', type=int, required=True, help='Length of the generated text.')
     generate_parser.add_argument('--seed', type=str, default=None, help='Optional seed string for deterministic generation.')
     generate_parser.add_argument('--random-seed', type=int, default=None, help='Optional random seed for reproducibility.')
@@ -22,19 +22,16 @@ def main(argv: list[str] | None = None) -> int:
     args = parser.parse_args(argv)
 
     if args.command == 'train':
-        with open(args.input, 'r', encoding='utf-8') as f:
-            text = f.read()
         mc = MarkovChain(order=args.order)
-        mc.train(text)
-        with open(args.model_out, 'w', encoding='utf-8') as f:
-            json.dump(mc.to_dict(), f)
+        with open(args.input, 'r', encoding='utf-8') as f:
+            mc.train_iter(iter(lambda: f.read(1 << 20), ''))
+        save_model(mc, args.model_out, args.format)
         return 0
     elif args.command == 'generate':
-        with open(args.model, 'r', encoding='utf-8') as f:
-            model_data = json.load(f)
-        mc = MarkovChain.from_dict(model_data)
-        generated_text = mc.generate(length=args.length, seed=args.seed, random_seed=args.random_seed)
-        print(generated_text)
+        mc = load_model(args.model)
+        for block in mc.generate_iter(length=args.length, seed=args.seed, random_seed=args.random_seed):
+            print(block, end='')
+        print()
         return 0
     else:
         parser.print_help()
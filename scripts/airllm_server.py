@@ -5,6 +5,8 @@ Poskytuje REST API kompatibilní s Ollama API formátem
 
 Instalace:
     pip install airllm flask
+    pip install orjson  # volitelné, rychlejší streamování
+    pip install waitress  # volitelné, produkční WSGI server
 
 Spuštění:
     python airllm_server.py --model "Qwen/Qwen2.5-72B-Instruct" --port 11435
@@ -17,19 +19,57 @@ Podporuje:
 
 import argparse
 import json
+import logging
+import queue
+import sys
 import time
 import threading
 import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from functools import lru_cache
 from typing import Optional, Generator
 from flask import Flask, request, jsonify, Response
 
+try:
+    import orjson
+except ImportError:  # volitelné, jen rychlejší NDJSON stream
+    orjson = None
+
+try:
+    import torch as _torch_module
+except ImportError:  # bez torch jde soubor aspoň načíst; dtype pak zůstane jménem
+    _torch_module = None
+
 # Lazy import airllm
 airllm_model = None
 airllm_tokenizer = None
-model_lock = threading.Lock()
+# Set once the model is loaded and patched; is_set() is a cheap check on every request.
+_model_ready = threading.Event()
+_model_loading_lock = threading.Lock()
+# Request-independent generate() arguments, filled in by load_model().
+_base_gen_kwargs = {}
+_LOG = logging.getLogger("airllm")
+
+# ((len_p, len_s), (cos, sin)) of the latest step; every layer of a step asks for the same pair, older steps never return.
+_rope_cache = None
+_rope_cache_lock = threading.Lock()
+
+# Every generation waits here as (input_ids, attention_mask, max_new_tokens, Future, streamer) for the batch worker.
+_pending = queue.Queue()
+_batch_worker = None
+_batch_worker_lock = threading.Lock()
+# How often a waiting request checks that the batch worker is still alive.
+_WORKER_POLL_S = 1.0
+# Pinned host staging for the batch worker, allocated on its first batch.
+_pinned_ids = None
+_pinned_mask = None
 
 app = Flask(__name__)
 
+
+class GenerationUnavailable(RuntimeError):
+    """Generovací vlákno neběží nebo nestihlo odpovědět; routy vrací 503"""
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     import traceback
@@ -42,6 +82,10 @@ def handle_exception(e):
     traceback.print_exc()
     return jsonify({"error": str(e), "message": "AirLLM Internal Server Error"}), 500
 
+@app.errorhandler(GenerationUnavailable)
+def handle_generation_unavailable(e):
+    return jsonify({"error": str(e), "message": "AirLLM Service Unavailable"}), 503
+
 
 # Konfigurace
 config = {
@@ -50,37 +94,121 @@ config = {
     "max_length": 2048,
     "delete_original": False,
     "dtype": "auto",
-    "use_kv_cache": False,
-    "loaded": False
+    "use_kv_cache": True,
+    "max_batch_size": 4,
+    "batch_timeout_ms": 50,
+    "generate_timeout": 1800,  # s; u streamu max. pauza mezi tokeny
+    "compile_mode": None  # None = bez torch.compile
+}
+
+
+def _torch_dtype(name: str):
+    return getattr(_torch_module, name) if _torch_module is not None else name
+
+
+_DTYPE_MAP = {
+    "": None,
+    "auto": None,
+    "none": None,
+    "bf16": _torch_dtype("bfloat16"),
+    "bfloat16": _torch_dtype("bfloat16"),
+    "fp16": _torch_dtype("float16"),
+    "float16": _torch_dtype("float16"),
+    "fp32": _torch_dtype("float32"),
+    "float32": _torch_dtype("float32")
 }
 
 
-def resolve_dtype(value: Optional[str]) -> Optional[str]:
-    if not value:
-        return None
-    normalized = value.strip().lower()
-    if normalized in ("auto", "none"):
-        return None
-    mapping = {
-        "bf16": "bfloat16",
-        "bfloat16": "bfloat16",
-        "fp16": "float16",
-        "float16": "float16",
-        "fp32": "float32",
-        "float32": "float32"
-    }
-    return mapping.get(normalized)
+def resolve_dtype(value: Optional[str]):
+    """Převede hodnotu --dtype na torch dtype; None nechá volbu na AirLLM"""
+    try:
+        return _DTYPE_MAP[(value or "").strip().lower()]
+    except KeyError:
+        raise ValueError(f"Nepodporovaný dtype: {value!r}") from None
+
+
+def auto_dtype() -> str:
+    """Pro --dtype auto: bf16 na Ampere+ (compute capability >= 8), fp16 na Volta/Turing, jinak auto"""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            major, _ = torch.cuda.get_device_capability()
+            if major >= 8:
+                return "bf16"
+            if major >= 7:
+                return "fp16"
+    except Exception:
+        pass
+    return "auto"
+
+
+def auto_compression() -> Optional[str]:
+    """Pro --compression auto: 4bit NF4, pokud je k dispozici CUDA i bitsandbytes"""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            import bitsandbytes  # noqa: F401
+            return "4bit"
+    except Exception:
+        pass
+    return None
+
+
+def _airllm_forces_cache_off(model) -> bool:
+    """AirLLM 2.x ve forward() vypíná KV cache, kdykoli jde importovat transformers.cache_utils"""
+    for cls in type(model).__mro__:
+        if getattr(sys.modules.get(cls.__module__), "cache_utils_installed", False):
+            return True
+    return False
+
+
+def _rope_position_embeddings(model, rotary_provider, len_p: int, len_s: int) -> dict:
+    """
+    get_pos_emb_args pro AirLLM: RoPE (cos, sin) pro pozice len_p..len_p+len_s.
+    Všechny vrstvy jednoho kroku se ptají na stejný pár, proto se drží jen poslední.
+    """
+    global _rope_cache
+    import torch
+
+    if len_s <= 0:
+        return {}
+    key = (len_p, len_s)
+    with _rope_cache_lock:
+        cached = _rope_cache
+    if cached is not None and cached[0] == key:
+        return {"position_embeddings": cached[1]}
+    position_ids = torch.arange(
+        len_p, len_p + len_s, device=model.running_device, dtype=torch.long
+    ).unsqueeze(0)
+    # The provider only reads x's device and dtype; a stride-0 view allocates a single element.
+    dummy = torch.zeros((), device=model.running_device, dtype=model.running_dtype).expand(
+        1, len_s, model.config.hidden_size
+    )
+    cos, sin = rotary_provider(dummy, position_ids)
+    if _LOG.isEnabledFor(logging.DEBUG):
+        _LOG.debug(
+            f"[AirLLM] pos_emb len_p={len_p} len_s={len_s} cos={tuple(cos.shape)} sin={tuple(sin.shape)}"
+        )
+    # Align rotary dims with actual attention head_dim if needed (resolved once at load).
+    target_dim = model._airllm_target_head_dim
+    if target_dim and cos.shape[-1] != target_dim:
+        cos = cos[..., :target_dim]
+        sin = sin[..., :target_dim]
+    # Replacing the entry frees the previous step's tensors instead of piling them up in VRAM.
+    with _rope_cache_lock:
+        _rope_cache = (key, (cos, sin))
+    return {"position_embeddings": (cos, sin)}
 
 
 def load_model():
     """Načte AirLLM model (lazy loading)"""
-    global airllm_model, airllm_tokenizer
+    global airllm_model, airllm_tokenizer, _base_gen_kwargs, _rope_cache
     
-    if config["loaded"]:
+    if _model_ready.is_set():
         return True
     
-    with model_lock:
-        if config["loaded"]:
+    with _model_loading_lock:
+        if _model_ready.is_set():
             return True
             
         try:
@@ -95,13 +223,9 @@ def load_model():
             }
             if config["compression"]:
                 kwargs["compression"] = config["compression"]
-            dtype_name = resolve_dtype(config.get("dtype"))
-            if dtype_name:
-                try:
-                    import torch
-                    kwargs["dtype"] = getattr(torch, dtype_name, dtype_name)
-                except Exception:
-                    kwargs["dtype"] = dtype_name
+            dtype = resolve_dtype(config.get("dtype"))
+            if dtype is not None:
+                kwargs["dtype"] = dtype
             
             try:
                 airllm_model = AutoModel.from_pretrained(
@@ -119,7 +243,6 @@ def load_model():
                 else:
                     raise
             airllm_tokenizer = airllm_model.tokenizer
-            config["loaded"] = True
 
             # Compatibility with newer Transformers that expect _is_stateful on model classes.
             if not hasattr(airllm_model.__class__, "_is_stateful"):
@@ -138,9 +261,14 @@ def load_model():
                 use_cache = bool(config.get("use_kv_cache"))
                 airllm_model.generation_config.use_cache = use_cache
                 airllm_model.config.use_cache = use_cache
-                print(f"[AirLLM] KV cache: {'on' if use_cache else 'off'}", flush=True)
             except Exception:
                 pass
+            # What generation really gets; requesting the cache does nothing once AirLLM overrides it.
+            kv_cache_active = bool(config.get("use_kv_cache")) and not _airllm_forces_cache_off(airllm_model)
+            if config.get("use_kv_cache") and not kv_cache_active:
+                print("[AirLLM] KV cache: off (AirLLM ji s transformers.cache_utils vypíná)", flush=True)
+            else:
+                print(f"[AirLLM] KV cache: {'on' if kv_cache_active else 'off'}", flush=True)
 
             # Guard against invalid past_key_values injected by newer Transformers.
             try:
@@ -189,54 +317,16 @@ def load_model():
                     rotary_provider = airllm_model.model.model.rotary_emb
 
                 if rotary_provider is not None:
-                    import torch as _torch
                     if not hasattr(airllm_model, "_airllm_rotary_logged"):
                         print(f"[AirLLM] RoPE provider={type(rotary_provider)}", flush=True)
                         airllm_model._airllm_rotary_logged = True
 
+                    with _rope_cache_lock:
+                        _rope_cache = None
+                    airllm_model._airllm_target_head_dim = None
+
                     def patched_get_pos_emb_args(self, len_p, len_s):
-                        if len_s <= 0:
-                            return {}
-                        if not hasattr(self, "_airllm_pos_emb_logged"):
-                            print("[AirLLM] Patched position embeddings active")
-                            self._airllm_pos_emb_logged = True
-                        position_ids = _torch.arange(
-                            len_p, len_p + len_s, device=self.running_device, dtype=_torch.long
-                        ).unsqueeze(0)
-                        dummy = _torch.zeros(
-                            (1, len_s, self.config.hidden_size),
-                            device=self.running_device,
-                            dtype=self.running_dtype
-                        )
-                        cos, sin = rotary_provider(dummy, position_ids)
-                        if not hasattr(self, "_airllm_pos_emb_count"):
-                            self._airllm_pos_emb_count = 0
-                        if self._airllm_pos_emb_count < 5:
-                            print(
-                                f"[AirLLM] pos_emb len_p={len_p} len_s={len_s} cos={tuple(cos.shape)} sin={tuple(sin.shape)}",
-                                flush=True,
-                            )
-                            self._airllm_pos_emb_count += 1
-                        # Align rotary dims with actual attention head_dim if needed.
-                        target_dim = None
-                        try:
-                            layer_ref = None
-                            if hasattr(self.model, "model") and hasattr(self.model.model, "layers"):
-                                layer_ref = self.model.model.layers[0]
-                            elif hasattr(self.model, "layers"):
-                                layer_ref = self.model.layers[0]
-                            if layer_ref is not None:
-                                q_proj_out = getattr(layer_ref.self_attn.q_proj, "out_features", None)
-                                if q_proj_out and getattr(self.config, "num_attention_heads", None):
-                                    target_dim = q_proj_out // self.config.num_attention_heads
-                                if not target_dim:
-                                    target_dim = getattr(layer_ref.self_attn, "head_dim", None)
-                        except Exception:
-                            target_dim = None
-                        if target_dim and cos.shape[-1] != target_dim:
-                            cos = cos[..., :target_dim]
-                            sin = sin[..., :target_dim]
-                        return {"position_embeddings": (cos, sin)}
+                        return _rope_position_embeddings(self, rotary_provider, len_p, len_s)
 
                     airllm_model.__class__.get_pos_emb_args = patched_get_pos_emb_args
             except Exception:
@@ -249,46 +339,52 @@ def load_model():
 
                 if not getattr(_qwen2_modeling, "_airllm_rope_patch", False):
                     _orig_apply = _qwen2_modeling.apply_rotary_pos_emb
+                    _rotate_half = _qwen2_modeling.rotate_half
+
+                    def _specialize_rotary_pos_emb(q, cos):
+                        # The q/cos layout is fixed per model, so choose the variant once and
+                        # leave no shape checks on the per-layer, per-token path.
+                        transpose = cos.shape[-2] != q.shape[-2] and cos.shape[-1] == q.shape[-2] and cos.shape[-2] == q.shape[-1]
+                        rope_dim = cos.shape[-2] if transpose else cos.shape[-1]
+                        head_dim = q.shape[-1]
+
+                        if rope_dim == head_dim:
+                            apply = _orig_apply
+                        elif rope_dim > head_dim:
+                            def apply(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
+                                return _orig_apply(
+                                    q, k, cos[..., :head_dim], sin[..., :head_dim],
+                                    position_ids=position_ids, unsqueeze_dim=unsqueeze_dim
+                                )
+                        else:
+                            def apply(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
+                                cos_u = cos.unsqueeze(unsqueeze_dim)
+                                sin_u = sin.unsqueeze(unsqueeze_dim)
+                                q1, q2 = q[..., :rope_dim], q[..., rope_dim:]
+                                k1, k2 = k[..., :rope_dim], k[..., rope_dim:]
+                                q1 = (q1 * cos_u) + (_rotate_half(q1) * sin_u)
+                                k1 = (k1 * cos_u) + (_rotate_half(k1) * sin_u)
+                                return _torch.cat((q1, q2), dim=-1), _torch.cat((k1, k2), dim=-1)
+
+                        if transpose:
+                            inner = apply
+
+                            def apply(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
+                                return inner(
+                                    q, k, cos.transpose(-1, -2), sin.transpose(-1, -2),
+                                    position_ids=position_ids, unsqueeze_dim=unsqueeze_dim
+                                )
+
+                        return apply
 
                     def patched_apply_rotary_pos_emb(q, k, cos, sin, position_ids=None, unsqueeze_dim=1):
-                        if not hasattr(patched_apply_rotary_pos_emb, "_count"):
-                            patched_apply_rotary_pos_emb._count = 0
-                        if patched_apply_rotary_pos_emb._count < 5:
-                            print(
-                                f"[AirLLM] RoPE shapes q={tuple(q.shape)} cos={tuple(cos.shape)} sin={tuple(sin.shape)} unsqueeze_dim={unsqueeze_dim}",
-                                flush=True,
-                            )
-                            patched_apply_rotary_pos_emb._count += 1
-                        cos_adj = cos
-                        sin_adj = sin
-                        if cos_adj.shape[-2] != q.shape[-2] and cos_adj.shape[-1] == q.shape[-2] and cos_adj.shape[-2] == q.shape[-1]:
-                            cos_adj = cos_adj.transpose(-1, -2)
-                            sin_adj = sin_adj.transpose(-1, -2)
-                        if cos_adj.shape[-1] > q.shape[-1]:
-                            cos_adj = cos_adj[..., : q.shape[-1]]
-                            sin_adj = sin_adj[..., : q.shape[-1]]
-                        if cos_adj.shape[-1] < q.shape[-1]:
-                            cos_u = cos_adj.unsqueeze(unsqueeze_dim)
-                            sin_u = sin_adj.unsqueeze(unsqueeze_dim)
-                            dim = cos_adj.shape[-1]
-                            q1, q2 = q[..., :dim], q[..., dim:]
-                            k1, k2 = k[..., :dim], k[..., dim:]
-                            q1 = (q1 * cos_u) + (_qwen2_modeling.rotate_half(q1) * sin_u)
-                            k1 = (k1 * cos_u) + (_qwen2_modeling.rotate_half(k1) * sin_u)
-                            if not hasattr(patched_apply_rotary_pos_emb, "_logged"):
-                                print(
-                                    f"[AirLLM] RoPE dim fix applied q={q.shape[-1]} cos={cos.shape[-1]} target={dim}",
-                                    flush=True,
-                                )
-                                patched_apply_rotary_pos_emb._logged = True
-                            return _torch.cat((q1, q2), dim=-1), _torch.cat((k1, k2), dim=-1)
-                        if not hasattr(patched_apply_rotary_pos_emb, "_logged"):
-                            print(
-                                f"[AirLLM] RoPE dim ok q={q.shape[-1]} cos={cos.shape[-1]}",
-                                flush=True,
-                            )
-                            patched_apply_rotary_pos_emb._logged = True
-                        return _orig_apply(q, k, cos_adj, sin_adj, position_ids=position_ids, unsqueeze_dim=unsqueeze_dim)
+                        apply = _specialize_rotary_pos_emb(q, cos)
+                        # A square cos/sin does not reveal whether it is transposed; install on a later call.
+                        if cos.shape[-1] != cos.shape[-2]:
+                            _qwen2_modeling.apply_rotary_pos_emb = apply
+                            if _LOG.isEnabledFor(logging.DEBUG):
+                                _LOG.debug(f"[AirLLM] RoPE specialized q={tuple(q.shape)} cos={tuple(cos.shape)}")
+                        return apply(q, k, cos, sin, position_ids=position_ids, unsqueeze_dim=unsqueeze_dim)
 
                     _qwen2_modeling.apply_rotary_pos_emb = patched_apply_rotary_pos_emb
                     _qwen2_modeling._airllm_rope_patch = True
@@ -305,9 +401,6 @@ def load_model():
                             length = seq.shape[-2]
                         else:
                             length = seq.shape[0]
-                        if not hasattr(self, "_airllm_seq_len_logged"):
-                            print(f"[AirLLM] seq shape={tuple(seq.shape)} len={length}", flush=True)
-                            self._airllm_seq_len_logged = True
                         return length
                     except Exception:
                         return orig_get_sequence_len(self, seq)
@@ -332,34 +425,76 @@ def load_model():
                 except Exception:
                     pass
 
-                def _wrap_layer_forward(layer):
+                # Per layer class: True once its forward is seen returning a tuple, False for a bare tensor.
+                _returns_tuple = {}
+
+                def _restore_meta_params(layer, args):
+                    try:
+                        if getattr(layer.input_layernorm.weight, "is_meta", False):
+                            last_sd = getattr(airllm_model, "_airllm_last_state_dict", None)
+                            if last_sd is not None:
+                                airllm_model.move_layer_to_device(last_sd)
+                    except Exception:
+                        pass
+
+                def _wrap_layer_forward(layer, first=False):
                     if getattr(layer, "_airllm_tuple_wrap", False):
                         return
-                    if not (hasattr(layer, "self_attn") and hasattr(layer, "mlp")):
+                    layer._airllm_tuple_wrap = True
+                    if first and hasattr(layer, "input_layernorm"):
+                        layer.register_forward_pre_hook(_restore_meta_params)
+                    layer_cls = type(layer)
+                    returns_tuple = _returns_tuple.get(layer_cls)
+                    if returns_tuple:
                         return
                     orig_forward = layer.forward
 
-                    def wrapped_forward(*args, **kwargs):
-                        try:
-                            if hasattr(layer, "input_layernorm") and getattr(layer.input_layernorm.weight, "is_meta", False):
-                                last_sd = getattr(airllm_model, "_airllm_last_state_dict", None)
-                                if last_sd is not None:
-                                    airllm_model.move_layer_to_device(last_sd)
-                        except Exception:
-                            pass
+                    def tuple_forward(*args, **kwargs):
+                        return (orig_forward(*args, **kwargs),)
+
+                    if returns_tuple is False:
+                        layer.forward = tuple_forward
+                        return
+
+                    def probe_forward(*args, **kwargs):
+                        # The first call decides whether this layer class needs the tuple adapter at all.
                         out = orig_forward(*args, **kwargs)
-                        if isinstance(out, _torch.Tensor):
-                            return (out,)
-                        return out
+                        is_tensor = isinstance(out, _torch.Tensor)
+                        _returns_tuple[layer_cls] = not is_tensor
+                        layer.forward = tuple_forward if is_tensor else orig_forward
+                        return (out,) if is_tensor else out
 
-                    layer.forward = wrapped_forward
-                    layer._airllm_tuple_wrap = True
+                    layer.forward = probe_forward
+
+                def _decoder_layers(layers):
+                    return [l for l in layers if hasattr(l, "self_attn") and hasattr(l, "mlp")]
+
+                def _wrap_layers(layers):
+                    for _idx, _layer in enumerate(_decoder_layers(layers)):
+                        _wrap_layer_forward(_layer, first=_idx == 0)
+
+                # Compile the decoder layer class before wrapping, so every wrapper binds the compiled forward.
+                # AirLLM rebuilds the model each forward call, which rules out compiling the model itself.
+                if config.get("compile_mode") and hasattr(airllm_model, "layers"):
+                    try:
+                        _decoders = _decoder_layers(airllm_model.layers)
+                        if _decoders and not getattr(type(_decoders[0]), "_airllm_compiled", False):
+                            _layer_cls = type(_decoders[0])
+                            _layer_cls.forward = _torch.compile(
+                                _layer_cls.forward,
+                                mode=config["compile_mode"],
+                                dynamic=True,
+                                fullgraph=False
+                            )
+                            _layer_cls._airllm_compiled = True
+                            print(f"[AirLLM] torch.compile {_layer_cls.__name__}.forward mode={config['compile_mode']}", flush=True)
+                    except Exception as e:
+                        print(f"[AirLLM] torch.compile selhal, pokračuji bez něj: {e}", flush=True)
 
                 if hasattr(airllm_model, "layers"):
                     for _idx, _layer in enumerate(airllm_model.layers[:5]):
                         print(f"[AirLLM] layer[{_idx}] class={_layer.__class__.__name__}", flush=True)
-                    for _layer in airllm_model.layers:
-                        _wrap_layer_forward(_layer)
+                    _wrap_layers(airllm_model.layers)
 
                 # Ensure wrapping persists after AirLLM re-initializes the model each forward call.
                 orig_init_model = airllm_model.__class__.init_model
@@ -368,8 +503,7 @@ def load_model():
                     orig_init_model(self)
                     try:
                         if hasattr(self, "layers"):
-                            for _layer in self.layers:
-                                _wrap_layer_forward(_layer)
+                            _wrap_layers(self.layers)
                     except Exception:
                         pass
 
@@ -388,10 +522,19 @@ def load_model():
                 head_dim_calc = None
                 if q_proj_out and getattr(airllm_model.config, "num_attention_heads", None):
                     head_dim_calc = q_proj_out // airllm_model.config.num_attention_heads
+                # The RoPE position-embedding patch trims cos/sin to this.
+                airllm_model._airllm_target_head_dim = head_dim_calc or head_dim
                 print(f"[AirLLM] Qwen2 config hidden={airllm_model.config.hidden_size} heads={airllm_model.config.num_attention_heads} head_dim={head_dim} q_proj_out={q_proj_out} head_dim_calc={head_dim_calc}")
             except Exception:
                 pass
             
+            _base_gen_kwargs = {
+                "use_cache": kv_cache_active,
+                "return_dict_in_generate": True
+            }
+            if airllm_tokenizer.eos_token_id is not None:
+                _base_gen_kwargs["pad_token_id"] = airllm_tokenizer.eos_token_id
+            _model_ready.set()
             print("[AirLLM] Model úspěšně načten!")
             return True
             
@@ -400,71 +543,316 @@ def load_model():
             return False
 
 
-def generate_response(prompt: str, max_new_tokens: int = 512) -> str:
-    """Generuje odpověď pomocí AirLLM"""
+@lru_cache(maxsize=256)
+def _tokenize_cached(prompt: str, add_special_tokens: bool = True):
+    """Tokenizuje prompt na CPU; opakované prompty se znovu netokenizují"""
+    return airllm_tokenizer(
+        prompt,
+        return_tensors="pt",
+        return_attention_mask=True,
+        add_special_tokens=add_special_tokens,
+        truncation=True,
+        max_length=config["max_length"],
+        padding=False
+    )
+
+
+def _apply_chat_template(messages: tuple) -> str:
+    """Vykreslí (role, content) dvojice nativní chat šablonou modelu"""
+    return airllm_tokenizer.apply_chat_template(
+        [{"role": role, "content": content} for role, content in messages],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+
+
+_render_chat_template = lru_cache(maxsize=256)(_apply_chat_template)
+
+
+def _is_hashable(value) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def build_chat_prompt(messages: list) -> tuple[str, bool]:
+    """
+    Sestaví prompt z messages; vrací (prompt, zda ho vykreslila chat šablona modelu).
+    Bez načteného tokenizeru nebo chat šablony použije prosté "Role: content" bloky.
+    """
+    key = tuple((msg.get('role', 'user'), msg.get('content', '')) for msg in messages)
+    if airllm_tokenizer is not None and getattr(airllm_tokenizer, "chat_template", None):
+        # Content given as a list of parts cannot key the cache; the template still gets it unchanged.
+        if not _is_hashable(key):
+            return _apply_chat_template(key), True
+        return _render_chat_template(key), True
+    
+    prompt_parts = []
+    for role, content in key:
+        if role == 'system':
+            prompt_parts.append(f"System: {content}")
+        elif role == 'user':
+            prompt_parts.append(f"User: {content}")
+        elif role == 'assistant':
+            prompt_parts.append(f"Assistant: {content}")
+    
+    prompt_parts.append("Assistant:")
+    return "\n\n".join(prompt_parts), False
+
+
+def _generation_kwargs(max_new_tokens: int, attention_mask=None) -> dict:
+    """Argumenty pro airllm_model.generate mimo samotné input_ids"""
+    generation_kwargs = _base_gen_kwargs | {"max_new_tokens": max_new_tokens}
+    # Some transformer backends require attention_mask; include when available.
+    if attention_mask is not None:
+        generation_kwargs["attention_mask"] = attention_mask
+    return generation_kwargs
+
+
+def _collect_jobs() -> list:
+    """Počká na první požadavek a přibere ty, které dorazí do batch_timeout_ms"""
+    jobs = [_pending.get()]
+    if not _batchable(jobs[0]):
+        # A stream or a KV-cache run goes alone anyway; waiting for company would only delay it.
+        return jobs
+    deadline = time.monotonic() + config["batch_timeout_ms"] / 1000
+    while len(jobs) < config["max_batch_size"]:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            jobs.append(_pending.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return jobs
+
+
+def _batchable(job) -> bool:
+    # use_cache is the effective state from load_model(): when the KV cache really runs (older
+    # transformers), AirLLM hands every row the whole batch's cache. A streamer follows one sequence.
+    return job[4] is None and not _base_gen_kwargs.get("use_cache")
+
+
+def _group_jobs(jobs: list) -> list:
+    """
+    Rozdělí požadavky na dávky, které smí sdílet jedno volání generate.
+    AirLLM ignoruje attention_mask i position_ids a staví si vlastní kauzální masku,
+    takže spolu jdou jen prompty se stejným počtem tokenů, bez paddingu. Dávka běží
+    do nejdelšího max_new_tokens, proto se seskupuje i podle něj a krátké požadavky
+    nečekají na dlouhé. Pořadí dávek odpovídá příchodu jejich prvního požadavku.
+    """
+    groups = []
+    by_shape = {}
+    for job in jobs:
+        if not _batchable(job):
+            groups.append([job])
+            continue
+        key = (job[0].shape[-1], job[2])
+        group = by_shape.get(key)
+        if group is None or len(group) >= config["max_batch_size"]:
+            group = by_shape[key] = []
+            groups.append(group)
+        group.append(job)
+    return groups
+
+
+def _input_device() -> str:
+    """Zařízení, na kterém AirLLM počítá; bez running_device výchozí cuda"""
+    return str(getattr(airllm_model, "running_device", "cuda"))
+
+
+def _staging_buffers(rows: int, width: int):
+    """Contiguous (rows, width) views into the worker's pinned buffers"""
+    global _pinned_ids, _pinned_mask
+    import torch
+
+    if _pinned_ids is None:
+        # Prompts are truncated to max_length, so one batch never needs more than this.
+        size = config["max_batch_size"] * config["max_length"]
+        # Pinning only pays off for host-to-GPU copies, and needs a CUDA runtime.
+        pin = torch.device(_input_device()).type == "cuda"
+        _pinned_ids = torch.empty(size, dtype=torch.long, pin_memory=pin)
+        _pinned_mask = torch.empty(size, dtype=torch.long, pin_memory=pin)
+    count = rows * width
+    return _pinned_ids[:count].view(rows, width), _pinned_mask[:count].view(rows, width)
+
+
+def _run_batch(batch: list) -> list:
+    """Vygeneruje dávku stejně dlouhých promptů se stejným max_new_tokens jedním průchodem vah; vrací nové tokeny pro každý řádek"""
+    width = batch[0][0].shape[-1]
+    input_ids, attention_mask = _staging_buffers(len(batch), width)
+    for row, (ids, mask, _, _, _) in enumerate(batch):
+        input_ids[row] = ids[0]
+        attention_mask[row] = 1 if mask is None else mask[0]
+    max_new_tokens = batch[0][2]
+    device = _input_device()
+    generation_kwargs = _generation_kwargs(max_new_tokens, attention_mask.to(device, non_blocking=True))
+    streamer = batch[0][4]
+    if streamer is not None:
+        generation_kwargs["streamer"] = streamer
+
+    # The buffers are only refilled by the next batch, after this synchronous generate has consumed them.
+    generation_output = airllm_model.generate(input_ids.to(device, non_blocking=True), **generation_kwargs)
+    return [generation_output.sequences[row, width:] for row in range(len(batch))]
+
+
+def _batch_loop():
+    # The only thread that calls generate: AirLLM rebuilds its model on every forward, so runs must not overlap.
+    while True:
+        # Requests that timed out while queued cancelled their Future; skip them.
+        jobs = [job for job in _collect_jobs() if job[3].set_running_or_notify_cancel()]
+        for batch in _group_jobs(jobs):
+            try:
+                rows = _run_batch(batch)
+            except Exception as e:
+                for *_, future, streamer in batch:
+                    if streamer is not None:
+                        # Without the end signal the streamer would block the consumer forever.
+                        streamer.end()
+                    future.set_exception(e)
+                continue
+            for (*_, future, _), new_tokens in zip(batch, rows):
+                future.set_result(new_tokens)
+
+
+def _ensure_batch_worker():
+    """Spustí generovací vlákno, případně znovu, pokud skončilo; jinak GenerationUnavailable"""
+    global _batch_worker
+    if _batch_worker is not None and _batch_worker.is_alive():
+        return
+    with _batch_worker_lock:
+        if _batch_worker is not None and _batch_worker.is_alive():
+            return
+        if _batch_worker is not None:
+            print("[AirLLM] Generovací vlákno skončilo, spouštím nové", flush=True)
+        worker = threading.Thread(target=_batch_loop, name="airllm-batch", daemon=True)
+        try:
+            worker.start()
+        except RuntimeError as e:
+            raise GenerationUnavailable(f"Generovací vlákno nejde spustit: {e}") from e
+        _batch_worker = worker
+
+
+def _check_worker(deadline: float):
+    if not _batch_worker.is_alive():
+        raise GenerationUnavailable("Generovací vlákno skončilo")
+    if time.monotonic() >= deadline:
+        raise GenerationUnavailable(f"Generování nestihlo odpovědět do {config['generate_timeout']} s")
+
+
+def _wait_result(future: Future):
+    """Počká na výsledek Future; skončí-li worker nebo vyprší generate_timeout, vyhodí GenerationUnavailable"""
+    deadline = time.monotonic() + config["generate_timeout"]
+    while True:
+        try:
+            return future.result(timeout=_WORKER_POLL_S)
+        except FutureTimeout:
+            pass
+        try:
+            _check_worker(deadline)
+        except GenerationUnavailable:
+            # A job still waiting in the queue is dropped by the worker instead of being generated for nobody.
+            future.cancel()
+            raise
+
+
+def _submit(prompt: str, max_new_tokens: int, streamer=None, add_special_tokens: bool = True) -> Future:
+    """Zařadí prompt do fronty generovacího vlákna; Future dostane nové tokeny"""
+    input_tokens = _tokenize_cached(prompt, add_special_tokens)
+    future = Future()
+    _ensure_batch_worker()
+    _pending.put((input_tokens['input_ids'], input_tokens.get('attention_mask'), max_new_tokens, future, streamer))
+    return future
+
+
+def generate_response(prompt: str, max_new_tokens: int = 512, add_special_tokens: bool = True) -> str:
+    """Generuje odpověď pomocí AirLLM; souběžné stejně dlouhé prompty sdílí jednu dávku"""
     if not load_model():
         return "[Chyba: Model není načten]"
     
     try:
-        input_tokens = airllm_tokenizer(
-            prompt,
-            return_tensors="pt",
-            return_attention_mask=True,
-            truncation=True,
-            max_length=config["max_length"],
-            padding=False
-        )
-        
-        input_ids = input_tokens['input_ids'].cuda()
-        attention_mask = input_tokens.get('attention_mask')
-        if attention_mask is not None:
-            attention_mask = attention_mask.cuda()
-        
-        # Some transformer backends require attention_mask; include when available.
-        generation_kwargs = {
-            "max_new_tokens": max_new_tokens,
-            "use_cache": bool(config.get("use_kv_cache")),
-            "return_dict_in_generate": True
-        }
-        if attention_mask is not None:
-            generation_kwargs["attention_mask"] = attention_mask
-        if airllm_tokenizer.eos_token_id is not None:
-            generation_kwargs["pad_token_id"] = airllm_tokenizer.eos_token_id
-        
-        generation_output = airllm_model.generate(
-            input_ids,
-            **generation_kwargs
-        )
+        future = _submit(prompt, max_new_tokens, add_special_tokens=add_special_tokens)
         
         output = airllm_tokenizer.decode(
-            generation_output.sequences[0],
+            _wait_result(future),
             skip_special_tokens=True
         )
         
-        # Odstraň původní prompt z výstupu
-        if output.startswith(prompt):
-            output = output[len(prompt):].strip()
-        
-        return output
+        return output.strip()
         
+    except GenerationUnavailable:
+        raise
     except Exception as e:
         print(f"[AirLLM] Chyba generování: {e}")
         traceback.print_exc()
         return f"[Chyba generování: {e}]"
 
 
-def generate_stream(prompt: str, max_new_tokens: int = 512) -> Generator[str, None, None]:
+def generate_stream(prompt: str, max_new_tokens: int = 512, add_special_tokens: bool = True) -> Generator[str, None, None]:
     """
-    Streamuje odpověď po částech.
-    Poznámka: AirLLM nativně nepodporuje streaming, simulujeme ho.
+    Streamuje odpověď po tokenech, jak je model generuje.
+    Generování běží ve sdíleném generovacím vlákně, TextIteratorStreamer předává dekódovaný text.
     """
-    response = generate_response(prompt, max_new_tokens)
+    if not load_model():
+        yield "[Chyba: Model není načten]"
+        return
     
-    # Simulace streamingu - posíláme po slovech
-    words = response.split()
-    for i, word in enumerate(words):
-        yield word + (" " if i < len(words) - 1 else "")
-        time.sleep(0.02)  # Malé zpoždění pro plynulý stream
+    try:
+        from transformers import TextIteratorStreamer
+        
+        # A timeout on each read lets the loop notice a dead or stalled worker.
+        streamer = TextIteratorStreamer(
+            airllm_tokenizer, skip_prompt=True, timeout=_WORKER_POLL_S, skip_special_tokens=True
+        )
+        future = _submit(prompt, max_new_tokens, streamer, add_special_tokens)
+        deadline = time.monotonic() + config["generate_timeout"]
+        while True:
+            try:
+                text = next(streamer)
+            except StopIteration:
+                break
+            except queue.Empty:
+                try:
+                    _check_worker(deadline)
+                except GenerationUnavailable:
+                    future.cancel()
+                    raise
+                continue
+            deadline = time.monotonic() + config["generate_timeout"]
+            if text:
+                yield text
+        # Re-raises a generation error; the worker ended the streamer before setting it.
+        _wait_result(future)
+        
+    except Exception as e:
+        print(f"[AirLLM] Chyba generování: {e}")
+        traceback.print_exc()
+        yield f"[Chyba generování: {e}]"
+
+
+if orjson is not None:
+    def _ndjson_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    def _ndjson_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _ndjson_line(obj) -> bytes:
+    return _ndjson_dumps(obj) + b"\n"
+
+
+def _chunk_framer(build):
+    """
+    Zakóduje obálku NDJSON řádku jednou; pro každý chunk se kóduje jen jeho text.
+    build(text) vrací dict, ve kterém se text objeví právě jednou.
+    """
+    marker = "\u0000airllm-chunk\u0000"
+    head, tail = _ndjson_dumps(build(marker)).split(_ndjson_dumps(marker), 1)
+    tail += b"\n"
+    return lambda text: head + _ndjson_dumps(text) + tail
 
 
 @app.route('/api/tags', methods=['GET'])
@@ -511,18 +899,22 @@ def api_generate():
         return jsonify({"error": "Prompt is required"}), 400
     
     if stream:
+        # Once the stream starts the status is sent; a dead worker has to surface as 503 before that.
+        _ensure_batch_worker()
+
         def generate():
+            frame = _chunk_framer(lambda text: {
+                "model": config["model_id"],
+                "response": text,
+                "done": False
+            })
             for chunk in generate_stream(prompt, max_tokens):
-                yield json.dumps({
-                    "model": config["model_id"],
-                    "response": chunk,
-                    "done": False
-                }) + "\n"
-            yield json.dumps({
+                yield frame(chunk)
+            yield _ndjson_line({
                 "model": config["model_id"],
                 "response": "",
                 "done": True
-            }) + "\n"
+            })
         
         return Response(generate(), mimetype='application/x-ndjson')
     else:
@@ -555,44 +947,38 @@ def api_chat():
     options = data.get('options', {})
     max_tokens = options.get('num_predict', 512)
     
-    # Sestavení promptu z messages
-    prompt_parts = []
-    for msg in messages:
-        role = msg.get('role', 'user')
-        content = msg.get('content', '')
-        if role == 'system':
-            prompt_parts.append(f"System: {content}")
-        elif role == 'user':
-            prompt_parts.append(f"User: {content}")
-        elif role == 'assistant':
-            prompt_parts.append(f"Assistant: {content}")
-    
-    prompt_parts.append("Assistant:")
-    full_prompt = "\n\n".join(prompt_parts)
+    # Sestavení promptu z messages; šablonu vykresluje tokenizer modelu, který request stejně potřebuje
+    load_model()
+    full_prompt, templated = build_chat_prompt(messages)
+    # A rendered template already carries BOS and the other special tokens.
+    add_special_tokens = not templated
     
     if stream:
+        _ensure_batch_worker()
+
         def generate():
-            for chunk in generate_stream(full_prompt, max_tokens):
-                yield json.dumps({
-                    "model": config["model_id"],
-                    "message": {
-                        "role": "assistant",
-                        "content": chunk
-                    },
-                    "done": False
-                }) + "\n"
-            yield json.dumps({
+            frame = _chunk_framer(lambda text: {
+                "model": config["model_id"],
+                "message": {
+                    "role": "assistant",
+                    "content": text
+                },
+                "done": False
+            })
+            for chunk in generate_stream(full_prompt, max_tokens, add_special_tokens):
+                yield frame(chunk)
+            yield _ndjson_line({
                 "model": config["model_id"],
                 "message": {
                     "role": "assistant",
                     "content": ""
                 },
                 "done": True
-            }) + "\n"
+            })
         
         return Response(generate(), mimetype='application/x-ndjson')
     else:
-        response = generate_response(full_prompt, max_tokens)
+        response = generate_response(full_prompt, max_tokens, add_special_tokens)
         return jsonify({
             "model": config["model_id"],
             "message": {
@@ -624,9 +1010,9 @@ def health():
     return jsonify({
         "status": "ok",
         "model": config["model_id"],
-        "loaded": config["loaded"],
+        "loaded": _model_ready.is_set(),
         "compression": config["compression"],
-        "kv_cache": config.get("use_kv_cache", False)
+        "kv_cache": _base_gen_kwargs.get("use_cache", False) if _model_ready.is_set() else config.get("use_kv_cache", True)
     })
 
 
@@ -659,9 +1045,9 @@ def main():
     parser.add_argument(
         "--compression", "-c",
         type=str,
-        choices=["4bit", "8bit", "none"],
-        default="none",
-        help="Komprese modelu pro rychlejší inference"
+        choices=["auto", "4bit", "8bit", "none"],
+        default="auto",
+        help="Komprese modelu pro rychlejší inference (auto = 4bit, je-li CUDA a bitsandbytes)"
     )
     parser.add_argument(
         "--port", "-p",
@@ -690,8 +1076,46 @@ def main():
     )
     parser.add_argument(
         "--kv-cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="KV cache (default: on; faster decoding, higher VRAM usage)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Počet obslužných vláken serveru waitress (default: 4)"
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=4,
+        help="Max. počet souběžných požadavků v jedné dávce (default: 4)"
+    )
+    parser.add_argument(
+        "--batch-timeout-ms",
+        type=int,
+        default=50,
+        help="Jak dlouho čekat na další požadavky do dávky (default: 50 ms)"
+    )
+    parser.add_argument(
+        "--generate-timeout",
+        type=float,
+        default=1800,
+        help="Max. čekání na odpověď v sekundách, u streamu na další token; pak 503 (default: 1800)"
+    )
+    parser.add_argument(
+        "--compile",
+        nargs="?",
+        const="default",
+        default=None,
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="Zkompilovat decoder vrstvy přes torch.compile (pomalý start; reduce-overhead = CUDA grafy)"
+    )
+    parser.add_argument(
+        "--verbose", "-v",
         action="store_true",
-        help="Enable KV cache (faster decoding, higher VRAM usage)"
+        help="Debug výpisy z patchů (tvary RoPE apod.)"
     )
     parser.add_argument(
         "--preload",
@@ -705,21 +1129,39 @@ def main():
     )
     
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # --verbose is for our patch diagnostics; torch, transformers and werkzeug stay at INFO.
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(message)s"))
+    _LOG.addHandler(_log_handler)
+    _LOG.propagate = False
+    _LOG.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     
     # Nastavení konfigurace
     config["model_id"] = args.model
-    config["compression"] = args.compression if args.compression != "none" else None
+    if args.compression == "auto":
+        config["compression"] = auto_compression()
+    else:
+        config["compression"] = args.compression if args.compression != "none" else None
     config["max_length"] = args.max_length
     config["delete_original"] = args.delete_original
-    config["dtype"] = args.dtype
+    config["dtype"] = auto_dtype() if args.dtype == "auto" else args.dtype
+    try:
+        resolve_dtype(config["dtype"])
+    except ValueError as e:
+        parser.error(str(e))
     config["use_kv_cache"] = args.kv_cache
+    config["max_batch_size"] = max(1, args.max_batch_size)
+    config["batch_timeout_ms"] = max(0, args.batch_timeout_ms)
+    config["generate_timeout"] = max(_WORKER_POLL_S, args.generate_timeout)
+    config["compile_mode"] = args.compile
     
     print("=" * 60)
     print("  AirLLM Server pro Shumilek VS Code Extension")
     print("=" * 60)
     print(f"  Model:     {config['model_id']}")
     print(f"  Komprese:  {config['compression'] or 'žádná'}")
-    print(f"  DType:     {config['dtype']}")
+    print(f"  DType:     {config['dtype']}{' (auto)' if args.dtype == 'auto' else ''}")
     print(f"  KV cache:  {'on' if config['use_kv_cache'] else 'off'}")
     print(f"  Port:      {args.port}")
     print(f"  Max délka: {config['max_length']}")
@@ -735,7 +1177,14 @@ def main():
     print("[AirLLM] Pro Shumilek nastav: shumilek.baseUrl = http://localhost:11435")
     print()
     
-    app.run(host=args.host, port=args.port, threaded=True)
+    try:
+        from waitress import serve
+    except ImportError:
+        print("[AirLLM] waitress není nainstalován, běží vývojový server Flask")
+        app.run(host=args.host, port=args.port, threaded=True)
+    else:
+        # A bounded thread pool instead of a new thread per connection.
+        serve(app, host=args.host, port=args.port, threads=max(1, args.threads))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+import importlib.util
+import json
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_HAS_FLASK = importlib.util.find_spec("flask") is not None
+_HAS_TORCH = importlib.util.find_spec("torch") is not None
+if _HAS_FLASK:
+    import airllm_server as server
+if _HAS_TORCH:
+    import torch
+
+
+class _ServerState(unittest.TestCase):
+    """Restores the module globals a test replaces, so tests do not depend on run order."""
+
+    _GLOBALS = (
+        "airllm_model", "airllm_tokenizer", "_base_gen_kwargs", "_pinned_ids", "_pinned_mask", "_WORKER_POLL_S",
+        "_rope_cache",
+    )
+
+    def setUp(self):
+        saved = {name: getattr(server, name) for name in self._GLOBALS}
+        config = dict(server.config)
+        ready = server._model_ready.is_set()
+
+        def restore():
+            for name, value in saved.items():
+                setattr(server, name, value)
+            server.config.clear()
+            server.config.update(config)
+            if ready:
+                server._model_ready.set()
+            else:
+                server._model_ready.clear()
+            server._tokenize_cached.cache_clear()
+            server._render_chat_template.cache_clear()
+
+        self.addCleanup(restore)
+        server._tokenize_cached.cache_clear()
+        server._render_chat_template.cache_clear()
+
+
+class _FakeTokenizer:
+    eos_token_id = 0
+    pad_token_id = 0
+    chat_template = None
+
+    def __call__(self, prompt, add_special_tokens=True, **kwargs):
+        ids = [ord(ch) % 97 + 1 for ch in prompt]
+        if add_special_tokens:
+            ids.insert(0, 98)
+        ids = torch.tensor([ids], dtype=torch.long)
+        return {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " ".join(str(int(i)) for i in ids)
+
+
+class _FakeOutput:
+    def __init__(self, sequences):
+        self.sequences = sequences
+
+
+class _FakeModel:
+    """Greedy stand-in: each new token depends only on its own row, like a correct batched forward."""
+
+    running_device = "cpu"
+
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def generate(self, input_ids, max_new_tokens, attention_mask=None, streamer=None, **kwargs):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.calls.append((tuple(input_ids.shape), max_new_tokens, streamer))
+            sequences = input_ids.clone()
+            for _ in range(max_new_tokens):
+                nxt = (sequences.sum(dim=1, keepdim=True) * 31 + sequences[:, -1:]) % 89 + 1
+                sequences = torch.cat([sequences, nxt], dim=1)
+            if streamer is not None:
+                streamer.end()
+            return _FakeOutput(sequences)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class _FakeStreamer:
+    def __init__(self):
+        self.ended = False
+
+    def end(self):
+        self.ended = True
+
+
+@unittest.skipUnless(_HAS_FLASK and _HAS_TORCH, "requires flask and torch")
+class TestBatching(_ServerState):
+    def setUp(self):
+        super().setUp()
+        self.model = _FakeModel()
+        server.airllm_model = self.model
+        server.airllm_tokenizer = _FakeTokenizer()
+        server._base_gen_kwargs = {"use_cache": False, "return_dict_in_generate": True, "pad_token_id": 0}
+        server._pinned_ids = server._pinned_mask = None
+        server.config["batch_timeout_ms"] = 200
+        server.config["max_batch_size"] = 4
+        server._model_ready.set()
+
+    def test_batched_output_matches_solo_output(self):
+        prompts = [("abcd", 6), ("wxyz", 6), ("hello world", 5), ("dcba", 4)]
+        solo = [server.generate_response(prompt, limit) for prompt, limit in prompts]
+        self.model.calls.clear()
+
+        with ThreadPoolExecutor(len(prompts)) as pool:
+            batched = list(pool.map(lambda args: server.generate_response(*args), prompts))
+
+        self.assertEqual(batched, solo)
+        # Only the two four-character prompts with the same limit may share a call.
+        for (rows, width), limit, _ in self.model.calls:
+            if rows > 1:
+                self.assertEqual((width, limit), (5, 6))
+        self.assertLess(len(self.model.calls), len(prompts))
+
+    def test_group_jobs_splits_by_length_and_limit(self):
+        ids = lambda n: torch.ones((1, n), dtype=torch.long)
+        jobs = [(ids(3), None, 5, None, None), (ids(5), None, 5, None, None), (ids(3), None, 5, None, None),
+                (ids(3), None, 9, None, None)]
+        groups = server._group_jobs(jobs)
+        self.assertEqual([[(job[0].shape[-1], job[2]) for job in group] for group in groups],
+                         [[(3, 5), (3, 5)], [(5, 5)], [(3, 9)]])
+
+    def test_streams_run_alone_on_the_worker(self):
+        streamer = _FakeStreamer()
+        with ThreadPoolExecutor(3) as pool:
+            plain = [pool.submit(server.generate_response, "abcd", 4) for _ in range(2)]
+            stream = server._submit("abcd", 4, streamer)
+            server._wait_result(stream)
+            for future in plain:
+                future.result()
+
+        self.assertTrue(streamer.ended)
+        self.assertEqual(self.model.max_active, 1)
+        for (rows, _), _, call_streamer in self.model.calls:
+            if call_streamer is streamer:
+                self.assertEqual(rows, 1)
+
+    def test_active_kv_cache_disables_batching(self):
+        server._base_gen_kwargs["use_cache"] = True
+        with ThreadPoolExecutor(3) as pool:
+            list(pool.map(lambda _: server.generate_response("abcd", 3), range(3)))
+        self.assertTrue(all(shape[0] == 1 for shape, _, _ in self.model.calls))
+
+    def test_dead_worker_raises_service_unavailable(self):
+        server._WORKER_POLL_S = 0.01
+        worker = server._batch_worker
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        server._batch_worker = dead
+        self.addCleanup(setattr, server, "_batch_worker", worker)
+
+        future = Future()
+        with self.assertRaises(server.GenerationUnavailable):
+            server._wait_result(future)
+        self.assertTrue(future.cancelled())
+        # The next submission starts a fresh worker instead of hanging.
+        self.assertTrue(server.generate_response("abcd", 2))
+        self.assertTrue(server._batch_worker.is_alive())
+
+
+class _TemplateTokenizer:
+    chat_template = "fake"
+
+    def __init__(self):
+        self.rendered = []
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        self.rendered.append(messages)
+        return repr(messages)
+
+
+@unittest.skipUnless(_HAS_FLASK, "requires flask")
+class TestChatPrompt(_ServerState):
+    def setUp(self):
+        super().setUp()
+        self.tokenizer = _TemplateTokenizer()
+        server.airllm_tokenizer = self.tokenizer
+
+    def test_string_content_is_cached(self):
+        messages = [{"role": "user", "content": "ahoj"}]
+        first = server.build_chat_prompt(messages)
+        self.assertEqual(server.build_chat_prompt(messages), first)
+        self.assertTrue(first[1])
+        self.assertEqual(len(self.tokenizer.rendered), 1)
+
+    def test_content_parts_render_without_cache(self):
+        parts = [{"type": "text", "text": "ahoj"}]
+        prompt, templated = server.build_chat_prompt([{"role": "user", "content": parts}])
+        self.assertEqual(self.tokenizer.rendered, [[{"role": "user", "content": parts}]])
+        self.assertIn("ahoj", prompt)
+        self.assertTrue(templated)
+
+    def test_plain_prompt_without_tokenizer(self):
+        server.airllm_tokenizer = None
+        prompt, templated = server.build_chat_prompt([{"role": "user", "content": "ahoj"}])
+        self.assertEqual(prompt, "User: ahoj\n\nAssistant:")
+        self.assertFalse(templated)
+
+
+class _CountingRotary:
+    def __init__(self, dim):
+        self.dim = dim
+        self.calls = 0
+
+    def __call__(self, x, position_ids):
+        self.calls += 1
+        freqs = position_ids[..., None].to(x.dtype) * torch.ones(self.dim, dtype=x.dtype)
+        return freqs.cos(), freqs.sin()
+
+
+@unittest.skipUnless(_HAS_FLASK and _HAS_TORCH, "requires flask and torch")
+class TestRopeCache(_ServerState):
+    def setUp(self):
+        super().setUp()
+        server._rope_cache = None
+        self.rotary = _CountingRotary(6)
+        self.model = SimpleNamespace(
+            running_device="cpu", running_dtype=torch.float32,
+            config=SimpleNamespace(hidden_size=8), _airllm_target_head_dim=None
+        )
+
+    def _pos_emb(self, len_p, len_s):
+        return server._rope_position_embeddings(self.model, self.rotary, len_p, len_s)
+
+    def test_same_step_hits_the_cache(self):
+        first = self._pos_emb(0, 5)["position_embeddings"]
+        second = self._pos_emb(0, 5)["position_embeddings"]
+        self.assertEqual(self.rotary.calls, 1)
+        self.assertIs(second[0], first[0])
+        self.assertIs(second[1], first[1])
+        self.assertEqual(tuple(first[0].shape), (1, 5, 6))
+
+    def test_new_step_replaces_the_entry(self):
+        self._pos_emb(0, 5)
+        cos, _ = self._pos_emb(0, 6)["position_embeddings"]
+        self.assertEqual(self.rotary.calls, 2)
+        self.assertEqual(server._rope_cache[0], (0, 6))
+        self.assertIs(server._rope_cache[1][0], cos)
+        self._pos_emb(0, 5)
+        self.assertEqual(self.rotary.calls, 3)
+
+    def test_trims_to_target_head_dim(self):
+        self.model._airllm_target_head_dim = 4
+        cos, sin = self._pos_emb(3, 2)["position_embeddings"]
+        self.assertEqual(cos.shape[-1], 4)
+        self.assertEqual(sin.shape[-1], 4)
+        self.assertTrue(torch.allclose(cos[0, 0], torch.full((4,), 3.0).cos()))
+
+    def test_empty_step_has_no_embeddings(self):
+        self.assertEqual(self._pos_emb(4, 0), {})
+        self.assertEqual(self.rotary.calls, 0)
+
+
+@unittest.skipUnless(_HAS_FLASK, "requires flask")
+class TestNdjsonFraming(unittest.TestCase):
+    def test_frame_matches_full_encoding(self):
+        build = lambda text: {"model": "m", "message": {"role": "assistant", "content": text}, "done": False}
+        frame = server._chunk_framer(build)
+        for text in ["", "ahoj", "řádek\n\"uvozovky\"", "tab\tand \u0000 nul", "😀"]:
+            line = frame(text)
+            self.assertTrue(line.endswith(b"\n"))
+            self.assertEqual(json.loads(line), build(text))
+            self.assertEqual(line, server._ndjson_line(build(text)))
+
+    def test_lines_are_compact_and_unescaped(self):
+        # orjson and the json fallback must produce the same compact, unescaped lines.
+        self.assertEqual(server._ndjson_line({"a": "é", "b": [1, 2]}), '{"a":"é","b":[1,2]}\n'.encode("utf-8"))
+
+
+@unittest.skipUnless(_HAS_FLASK, "requires flask")
+class TestResolveDtype(unittest.TestCase):
+    def test_aliases_map_to_the_same_dtype(self):
+        self.assertEqual(server.resolve_dtype("bf16"), server.resolve_dtype("bfloat16"))
+        self.assertEqual(server.resolve_dtype("fp16"), server.resolve_dtype(" FP16 "))
+        self.assertEqual(server.resolve_dtype("fp32"), server.resolve_dtype("float32"))
+
+    @unittest.skipUnless(_HAS_TORCH, "requires torch")
+    def test_names_resolve_to_torch_dtypes(self):
+        self.assertIs(server.resolve_dtype("bf16"), torch.bfloat16)
+        self.assertIs(server.resolve_dtype("float16"), torch.float16)
+        self.assertIs(server.resolve_dtype("fp32"), torch.float32)
+
+    def test_auto_and_empty_leave_the_choice_to_airllm(self):
+        for value in (None, "", "auto", "none", "AUTO"):
+            self.assertIsNone(server.resolve_dtype(value))
+
+    def test_unknown_value_is_rejected(self):
+        with self.assertRaises(ValueError):
+            server.resolve_dtype("int8")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,10 +54,10 @@ export function readAirLLMConfig(cfg: { get<T>(key: string, fallback: T): T }):
   return {
     serverUrl: cfg.get<string>('airllm.serverUrl', 'http://localhost:11435'),
     model: (cfg.get<string>('airllm.model', 'Qwen/Qwen2.5-72B-Instruct') || '').trim() || 'Qwen/Qwen2.5-72B-Instruct',
-    compression: (cfg.get<string>('airllm.compression', 'none') || '').trim() || 'none',
+    compression: (cfg.get<string>('airllm.compression', 'auto') || '').trim() || 'auto',
     dtype: (cfg.get<string>('airllm.dtype', 'auto') || '').trim() || 'auto',
     cacheDir: (cfg.get<string>('airllm.cacheDir', '') || '').trim(),
-    useKvCache: cfg.get<boolean>('airllm.useKvCache', false),
+    useKvCache: cfg.get<boolean>('airllm.useKvCache', true),
     runInWsl: cfg.get<boolean>('airllm.runInWsl', false),
     wslDistro: (cfg.get<string>('airllm.wslDistro', 'Ubuntu') || '').trim(),
     wslUser: (cfg.get<string>('airllm.wslUser', '') || '').trim(),
@@ -72,8 +72,8 @@ export function buildAirLLMStartCommand(
   airCfg: AirLLMConfig
 ): { command: string; baseUrl: string } {
   const { baseUrl, host, port } = parseServerUrl(airCfg.serverUrl, 'http://localhost:11435');
-  const kvCacheArg = airCfg.useKvCache ? '--kv-cache' : '';
-  const kvCacheFlag = kvCacheArg ? ` ${kvCacheArg}` : '';
+  const kvCacheArg = airCfg.useKvCache ? '--kv-cache' : '--no-kv-cache';
+  const kvCacheFlag = ` ${kvCacheArg}`;
 
   const scriptArg = airCfg.runInWsl ? toWslPath(scriptPath) : scriptPath;
   const templateValues: Record<string, string> = {
@@ -150,8 +150,12 @@ describe('airllm', () => {
       const cfg = { get<T>(_key: string, fallback: T): T { return fallback; } };
       const result = readAirLLMConfig(cfg);
       expect(result.model).to.equal('Qwen/Qwen2.5-72B-Instruct');
-      expect(result.compression).to.equal('none');
+      expect(result.compression).to.equal('auto');
+      expect(result.useKvCache).to.equal(true);
       expect(result.runInWsl).to.equal(false);
+      const { command } = buildAirLLMStartCommand('/server.py', result);
+      expect(command).to.include(' --kv-cache');
+      expect(command).not.to.include('--no-kv-cache');
     });
   });
 
@@ -171,9 +175,10 @@ describe('airllm', () => {
       expect(command).to.include('--kv-cache');
     });
 
-    it('omits KV cache flag when disabled', () => {
+    it('passes --no-kv-cache when disabled', () => {
       const { command } = buildAirLLMStartCommand('/server.py', defaultCfg({ useKvCache: false }));
-      expect(command).not.to.include('--kv-cache');
+      expect(command).to.include('--no-kv-cache');
+      expect(command).not.to.include(' --kv-cache');
     });
 
     it('uses custom command template when provided', () => {